@@ -1,9 +1,13 @@
 import pandas as pd
-from rdkit.Chem import AllChem, PandasTools
+import numpy as np
+from rdkit.Chem import AllChem, rdqueries
 from rdkit import Chem
 from datetime import date
-from typing import Optional, List
-import operator
+from typing import Optional, List, Sequence
+import multiprocessing
+import functools
+import gzip
+
 def align(mol_series: pd.Series, ref_hit: Chem.Mol, used_hit: Chem.Mol) -> pd.Series:
     """
     It happens...
@@ -17,15 +21,66 @@ def align(mol_series: pd.Series, ref_hit: Chem.Mol, used_hit: Chem.Mol) -> pd.Se
     :return:
     """
     rototrans = AllChem.GetAlignmentTransform(used_hit, ref_hit)[1]
-    new_mols = mol_series.apply(lambda mol: Chem.Mol())
-    new_mols.apply(lambda mol: AllChem.TransformConformer(mol.GetConformer(), rototrans))
-    return new_mols
+    new_mols = [Chem.Mol(mol) for mol in mol_series.values]
+    for mol in new_mols:
+        AllChem.TransformConformer(mol.GetConformer(), rototrans)
+    return pd.Series(new_mols, index=mol_series.index)
+
+def _mol_to_smiles_noH(binary: bytes) -> str:
+    """
+    Worker for ``mols_to_smiles``: the mol is sent as its RDKit binary as Chem.Mol does not pickle well.
+    """
+    return Chem.MolToSmiles(AllChem.RemoveAllHs(Chem.Mol(binary)))
+
+def mols_to_smiles(mols: Sequence[Chem.Mol],
+                   n_cores: Optional[int]=1,
+                   min_parallel: int=50_000,
+                   chunksize: int=64) -> List[str]:
+    """
+    Hydrogen-less SMILES of a sequence of molecules, optionally in parallel.
+
+    The process pool is opt-in: with the spawn start method (macOS, Windows)
+    the calling script needs an ``if __name__ == '__main__'`` guard.
+    Serially this is ~50 µs per mol, so the pool only pays off for large inputs.
+
+    :param mols: molecules
+    :param n_cores: number of processes, 1 (default) is serial, None is all cores.
+    :param min_parallel: fewer molecules than this are done serially regardless of ``n_cores``
+    :param chunksize: molecules per task sent to a worker
+    :return: list of SMILES
+    """
+    if n_cores == 1 or len(mols) < min_parallel:
+        return [Chem.MolToSmiles(AllChem.RemoveAllHs(mol)) for mol in mols]
+    binaries = [mol.ToBinary() for mol in mols]
+    with multiprocessing.Pool(n_cores) as pool:
+        return pool.map(_mol_to_smiles_noH, binaries, chunksize=chunksize)
+
+# ASCII non-word characters (``\W``) to underscores
+_NAME_TABLE = str.maketrans({chr(i): '_' for i in range(128) if not (chr(i).isalnum() or chr(i) == '_')})
+
+def _sanitize_name(name: str, letter_trim: int) -> str:
+    """
+    Replace non-word characters with underscores and trim to ``letter_trim`` characters.
+    """
+    if name.isascii():
+        return name.translate(_NAME_TABLE)[:letter_trim]
+    return ''.join(c if c.isalnum() or c == '_' else '_' for c in name)[:letter_trim]
 
-def floatify(value):
-    try:
-        return float(value)
-    except Exception:
-        return float('nan')
+def _prop_str(value) -> str:
+    """
+    SDF property value as ``PandasTools.WriteSDF`` formats it:
+    floats are not written in E notation and lose trailing zeros (0.00001 not 1e-05).
+    Missing values (None, NaN, ``pd.NA``, ``pd.NaT``) are written as 'nan', as a NaN float was.
+    Always a str, as ``SetProp`` rejects anything else.
+    """
+    if value is None or value is pd.NA or value is pd.NaT:
+        return 'nan'
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return 'nan'
+        s = '{:f}'.format(value).rstrip('0')
+        return s + '0' if s.endswith('.') else s
+    return str(value)
 
 def prep(df: pd.DataFrame,
          header: Chem.Mol,
@@ -35,7 +90,8 @@ def prep(df: pd.DataFrame,
          ref_mol_names: Optional[str]=None,
          ref_pdb_name: Optional[str]=None,
          extras: Optional[dict]=None,
-         letter_trim: int=20) -> None:
+         letter_trim: int=20,
+         n_cores: Optional[int]=1) -> None:
     """
     Prepare a SDF file for Fragalysis.
 
@@ -44,61 +100,112 @@ def prep(df: pd.DataFrame,
     :param header: Chem.Mol generated by ``generate_header`` for example
     :param mol_col: name of the column containing the molecules
     :param name_col: name of the column containing the names
-    :param outfile: name of the output file
+    :param outfile: name of the output file, gzipped if it ends in ``.gz``
     :param ref_mol_names: comma separated list of names of the reference molecules (for all hits). Ignored if present.
     :param ref_pdb_name: name of the protein to use. Ignored if present.
     :param extras: Extra fields to add to the SDF file, these need to be in the ``header`` Chem.Mol
+    :param letter_trim: maximum length of the names
+    :param n_cores: number of processes used to make the 'original SMILES' column if absent,
+                    see ``mols_to_smiles`` (default: 1, serial)
     :return:
     """
-    # no tuple columns
+    # no tuple columns. Either way a new frame is made, which is altered in place hereafter
     assert isinstance(df, pd.DataFrame), f'{df} is not a DataFrame'
-    df = df.rename(columns={c: ':'.join(map(str, c)) for c in df.columns if isinstance(c, tuple)}).copy()
+    if df.columns.nlevels > 1:
+        # a MultiIndex is all tuples: no need to check each label
+        df = df.copy(deep=False)
+        df.columns = [':'.join(map(str, c)) for c in df.columns]
+    elif any(isinstance(c, tuple) for c in df.columns):
+        df = df.rename(columns={c: ':'.join(map(str, c)) for c in df.columns if isinstance(c, tuple)})
+    else:
+        # new columns are added to this frame only, the caller's data is not touched
+        df = df.copy(deep=False)
     # sort inputs
     if 'ref_mols' in df.columns:
         pass
     elif ref_mol_names:
         df['ref_mols'] = ref_mol_names
     else:
-        ValueError('ref_mol_names is None and ref_mols is not in df.columns')
-    if 'original SMILES' in df.columns:
-        pass
-    else:
-        df['original SMILES'] = df[mol_col].apply(AllChem.RemoveAllHs).apply(Chem.MolToSmiles)
+        raise ValueError('ref_mol_names is None and ref_mols is not in df.columns')
     if 'ref_pdb' in df.columns:
         pass
     elif ref_pdb_name:
         df['ref_pdb'] = ref_pdb_name
     else:
-        ValueError('ref_pdb is None and ref_pdb is not in df.columns')
+        raise ValueError('ref_pdb is None and ref_pdb is not in df.columns')
+    if 'original SMILES' in df.columns:
+        # not ``astype(str)``: under pandas 3 that keeps NaN
+        df['original SMILES'] = df['original SMILES'].fillna('').map(str)
+    else:
+        df['original SMILES'] = mols_to_smiles(df[mol_col].values, n_cores=n_cores)
     # deal with extras
     if extras is None:
         extra_fields = []
     elif extras is True:
-        extras = []
-        for col in df.columns:
-            df[col] = df[col].apply(floatify)
-            if df[col].fillna(0).apply(abs).sum() > 0:
-                extras.append(col)
+        # every column that is numeric and not all zero/NaN.
+        # numeric dtypes need no coercion, only the rest go through ``pd.to_numeric``.
+        # dates and durations are not scores, but ``pd.to_numeric`` would make them nanosecond integers
+        candidates = df.drop(columns=[mol_col, name_col])\
+                       .select_dtypes(exclude=['datetime', 'datetimetz', 'timedelta'])
+        numeric = candidates.select_dtypes(include='number')
+        others = candidates.drop(columns=numeric.columns)
+        if len(others.columns):
+            numeric = pd.concat([numeric, others.apply(pd.to_numeric, errors='coerce')], axis=1)\
+                        .reindex(columns=candidates.columns)
+        sums = numeric.abs().sum(axis=0, skipna=True)
+        extra_fields = sums.index[sums > 0].tolist()
+        df[extra_fields] = numeric[extra_fields]
     elif isinstance(extras, dict):
         extra_fields = list(extras.keys())
     elif isinstance(extras, list):
         extra_fields = extras
     else:
         raise ValueError('extras should be a dict or a list')
-    df = df.copy()
-    df[name_col] = df[name_col].apply(str)\
-                                .str.replace(r'\W', '_', regex=True)\
-                                .apply(operator.itemgetter(slice(None, int(letter_trim))))
-    with open(outfile, 'w') as sdfh:
+    letter_trim = int(letter_trim)
+    df[name_col] = [_sanitize_name(str(name), letter_trim) for name in df[name_col].values]
+    # plain arrays per column, so the write loop does no pandas indexing
+    prop_cols = ['ref_pdb', 'ref_mols', 'original SMILES'] + extra_fields
+    mols = df[mol_col].to_numpy(dtype=object)
+    names = df[name_col].to_numpy(dtype=object)
+    prop_arrs = {prop: [_prop_str(value) for value in df[prop].values] for prop in prop_cols}
+    # one writer for header and body, over a 1 MiB buffer to avoid many small writes
+    if str(outfile).endswith('.gz'):
+        sdfh_opened = gzip.open(outfile, 'wt', compresslevel=1)
+    else:
+        sdfh_opened = open(outfile, 'w', buffering=1 << 20)
+    with sdfh_opened as sdfh:
         with Chem.SDWriter(sdfh) as w:
+            # only the header's and the Fragalysis fields, not whatever other properties the input mols carry,
+            # as PandasTools.WriteSDF did. Set before the first write, else RDKit warns
+            w.SetProps(list(dict.fromkeys([*header.GetPropNames(), *prop_cols])))
             w.write(header)
-        PandasTools.WriteSDF(df, sdfh, mol_col, name_col,
-                             ['ref_pdb', 'ref_mols', 'original SMILES'] + extra_fields)
+            for i in range(len(mols)):
+                # a full copy so the caller's mols are not altered (a quick copy would lose the conformer)
+                mol = Chem.Mol(mols[i])
+                mol.SetProp('_Name', names[i])
+                for prop, arr in prop_arrs.items():
+                    mol.SetProp(prop, arr[i])
+                w.write(mol)
 
 def floatify_columns(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """
+    Returns a copy of ``df`` with the given columns as floats, non-numeric values becoming NaN.
+    """
     df = df.copy()
-    for col in df.columns:
-        df[col] = df[col].apply(floatify)
+    df[columns] = df[columns].apply(pd.to_numeric, errors='coerce')
+    return df
+
+@functools.lru_cache(maxsize=8)
+def _embedded_banner(smiles: str) -> bytes:
+    """
+    Embedding is the slow part of ``generate_header`` and is the same for a given SMILES,
+    so the RDKit binary of the embedded mol is cached (a fresh Chem.Mol is made from it per call).
+    """
+    bannermol = Chem.MolFromSmiles(smiles)
+    params = AllChem.ETKDGv3()
+    params.randomSeed = 0xC0FFEE  # the banner is the same every time
+    AllChem.EmbedMolecule(bannermol, params)
+    return bannermol.ToBinary()
 
 def generate_header(method: str,
                     ref_url: Optional[str]= 'https://www.example.com',
@@ -123,24 +230,24 @@ def generate_header(method: str,
                     These will be present in all the molecules in the SDF for sortable tables!
     :return: Chem.Mol
     """
-    bannermol = Chem.MolFromSmiles(smiles)
+    bannermol = Chem.Mol(_embedded_banner(smiles))
     bannermol.SetProp('_Name', 'ver_1.2')
-    AllChem.EmbedMolecule(bannermol)
-    if extras is None:
-        extras = {}
-    for k, v in {'ref_url': ref_url,
-                 'submitter_name': submitter_name,
-                 'submitter_email': submitter_email,
-                    'submitter_institution': submitter_institution,
-                 'generation_date': generation_date,
-                 'method': method,
-                 }.items():
+    props = {'ref_url': ref_url,
+             'submitter_name': submitter_name,
+             'submitter_email': submitter_email,
+             'submitter_institution': submitter_institution,
+             'generation_date': generation_date,
+             'method': method,
+             }
+    if extras:
+        props.update({k: str(v) for k, v in extras.items()})
+    for k, v in props.items():
         bannermol.SetProp(k, v)
-    for k, v in extras.items():
-        bannermol.SetProp(k, str(v))
     return bannermol
 
 
+_DUMMY_QUERY = rdqueries.AtomNumEqualsQueryAtom(0)
+
 class DummyMasker:
     """
     Copied form rdkit_to_params.utils !
@@ -167,20 +274,24 @@ class DummyMasker:
         self.is_masked = False
         self.zahl = int(placekeeper_zahl)
         self.blank_Gasteiger = bool(blank_Gasteiger)
-        self.dummies = list(  mol.GetAtomsMatchingQuery(Chem.rdqueries.AtomNumEqualsQueryAtom(0))  )
+        self.dummies = tuple(mol.GetAtomsMatchingQuery(_DUMMY_QUERY))
 
     def mask(self):
+        zahl = self.zahl
+        sp3 = Chem.HybridizationType.SP3
         for dummy in self.dummies:
-            dummy.SetAtomicNum(self.zahl)
+            dummy.SetAtomicNum(zahl)
             dummy.SetBoolProp('dummy', True)
-            dummy.SetHybridization(Chem.HybridizationType.SP3)
+            dummy.SetHybridization(sp3)
         self.is_masked = True
 
     def unmask(self):
+        blank_Gasteiger = self.blank_Gasteiger
         for dummy in self.dummies:
             assert dummy.HasProp('dummy'), 'The atoms have changed somehow? (weird cornercase)'
             dummy.SetAtomicNum(0)
-            if dummy.HasProp('_GasteigerCharge') and self.blank_Gasteiger:
+            # python bool first: skips the RDKit call when not blanking
+            if blank_Gasteiger and dummy.HasProp('_GasteigerCharge'):
                 dummy.SetDoubleProp('_GasteigerCharge', 0.)
         self.is_masked = False
 